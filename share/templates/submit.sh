@@ -12,6 +12,7 @@
 #SBATCH --gres={{gpus}}
 {% if partition != "" %}#SBATCH --partition={{partition}}{% endif %}
 {% if constraint != "" %}#SBATCH --constraint={{constraint}}{% endif %}
+{% if nodelist %}#SBATCH --nodelist={{nodelist}}{% endif %}
 unset XDG_RUNTIME_DIR
 
 # Disable variable export with sbatch
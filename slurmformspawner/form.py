@@ -38,6 +38,11 @@ def select_multi_checkbox(field, **kwargs):
 class FakeMultiDict(dict):
     getlist = dict.__getitem__
 
+def gpu_count(gres):
+    if gres.startswith('gpu:'):
+        return int(gres.split(':')[-1])
+    return 0
+
 def resolve(value, *args, **kargs):
     if callable(value):
         return value(*args, **kargs)
@@ -162,17 +167,16 @@ class SbatchForm(Configurable):
             'feature' : SelectMultipleField("Feature constraints", validators=[self.validate_features], widget=select_multi_checkbox)
         }
         self.form = BaseForm(fields)
+        # empty values until load resolves the defaults
+        self.form.process()
         self.form['runtime'].filters = [float]
         self.slurm_api = slurm_api
+        self.username = username
         self.resolve = partial(resolve, api=self.slurm_api, user=username)
         self.ui_args = ui_args
-
-        # retrieve defaults from config
-        defaults = dict.fromkeys(fields.keys() - ['profile'])
-        for field in defaults:
-            defaults[field] = self.resolve(getattr(self, field).get('def'))
-
-        self.profile_args = {'default': {'name': 'Default', 'params': defaults}} | profile_args
+        self.user_options = user_options
+        self.extra_profile_args = profile_args
+        self.profile_args = None
 
         if parse_version(hub_version) >= parse_version('5.0.0'):
             self.bootstrap_version = 5
@@ -186,13 +190,29 @@ class SbatchForm(Configurable):
             dict_ = getattr(self, key)
             if dict_.get('lock') is True and dict_.get('def') is None:
                 raise Exception(f'You need to define a default value for {key} because it is locked.')
-            value = user_options[key] if key in user_options else self.resolve(getattr(self, key).get('def'))
+
+    def load(self):
+        """Resolve the default values, which can query Slurm, the first time
+        the form values are needed, so the form shell can be rendered without."""
+        if self.profile_args is not None:
+            return
+
+        # retrieve defaults from config
+        defaults = dict.fromkeys(self.form._fields.keys() - ['profile'])
+        for field in defaults:
+            defaults[field] = self.resolve(getattr(self, field).get('def'))
+
+        self.profile_args = {'default': {'name': 'Default', 'params': defaults}} | self.extra_profile_args
+
+        for key in self.form._fields.keys():
+            value = self.user_options[key] if key in self.user_options else self.resolve(getattr(self, key).get('def'))
             if not isinstance(self.form[key], SelectMultipleField):
                 value = [value]
             self.form[key].process(formdata=FakeMultiDict({key : value }))
 
     @property
     def data(self):
+        self.load()
         return self.form.data
 
     @property
@@ -200,6 +220,7 @@ class SbatchForm(Configurable):
         return self.form.errors
 
     def process(self, formdata):
+        self.load()
         profile = formdata.get('profile', ('default',))[0]
         profile_params = self.profile_args[profile]['params']
         for key in self.form._fields.keys():
@@ -212,6 +233,11 @@ class SbatchForm(Configurable):
                 self.form[key].process(formdata=FakeMultiDict({key : [profile_value]}))
 
     def validate(self):
+        # clamp the ranges to the limits of the account that was selected
+        self.config_runtime()
+        self.config_nprocs()
+        self.config_memory()
+        self.config_gpus()
         valid = True
         for key in self.form._fields.keys():
             lock = self.resolve(getattr(self, key).get('lock'))
@@ -219,7 +245,8 @@ class SbatchForm(Configurable):
                 valid = self.form[key].validate(self.form) and valid
         return valid
 
-    def render(self):
+    def configure(self, estimates=None):
+        self.load()
         self.config_runtime()
         self.config_nprocs()
         self.config_memory()
@@ -231,7 +258,78 @@ class SbatchForm(Configurable):
         self.config_account()
         self.config_partition()
         self.config_feature()
-        return Template(self.template).render(form=self.form, bootstrap_version=self.bootstrap_version, profile_params=self.profile_args)
+        if estimates:
+            self.config_estimates(estimates)
+
+    def render(self, stale_since=None, estimates=None):
+        self.configure(estimates)
+        return Template(self.template).render(form=self.form, bootstrap_version=self.bootstrap_version, profile_params=self.profile_args,
+                                              stale_since=stale_since, account_limits=self.account_limits())
+
+    def render_shell(self, options_url):
+        """Render the form without choices nor values, the form script
+        fetches them from options_url."""
+        profile_params = {'default': {'name': 'Default', 'params': {}}} | self.extra_profile_args
+        return Template(self.template).render(form=self.form, bootstrap_version=self.bootstrap_version, profile_params=profile_params,
+                                              stale_since=None, account_limits={}, options_url=options_url)
+
+    def options(self, stale_since=None, estimates=None):
+        """Return the choices, values and ranges of the form fields as they
+        would be rendered, in a JSON serializable dictionary."""
+        self.configure(estimates)
+        self.config_reservation_ends()
+        fields = {}
+        for key, field in self.form._fields.items():
+            fields[key] = {
+                'value': field.data,
+                'disabled': 'disabled' in (field.render_kw or {}),
+            }
+            if isinstance(field, SelectField):
+                fields[key]['choices'] = [list(choice) for choice in field.choices]
+                values = [value for value, _ in field.choices]
+                if not isinstance(field, SelectMultipleField) and field.data not in values:
+                    # let the browser select the first choice
+                    fields[key]['value'] = None
+            if isinstance(field.widget, NumberInput):
+                fields[key]['min'] = field.widget.min
+                fields[key]['max'] = field.widget.max
+                fields[key]['step'] = field.widget.step
+        return {
+            'fields': fields,
+            'profiles': self.profile_args,
+            'limits': self.account_limits(),
+            'stale_since': stale_since.strftime('%Y-%m-%d %H:%M:%S') if stale_since else None,
+        }
+
+    def selected_account(self):
+        accounts = self.resolve(self.account.get('choices'))
+        account = self.form['account'].data
+        if accounts and account not in accounts:
+            # the browser selects the first account when none is set
+            account = accounts[0]
+        return account
+
+    def limit_max(self, key, account):
+        max_ = self.resolve(getattr(self, key).get('max'))
+        limit = self.slurm_api.get_account_limits(self.username).get(account, {}).get(key)
+        if limit is None:
+            return max_
+        if max_ is None:
+            return limit
+        return min(max_, limit)
+
+    def account_limits(self):
+        limits = self.slurm_api.get_account_limits(self.username)
+        if not any(limits.values()):
+            return {}
+        account_limits = {}
+        for account in limits:
+            account_limits[account] = {}
+            for key in ('runtime', 'nprocs', 'memory'):
+                if not self.resolve(getattr(self, key).get('lock')):
+                    account_limits[account][key] = self.limit_max(key, account)
+            account_limits[account]['gpus'] = limits[account].get('gpus')
+        return account_limits
 
     def config_runtime(self):
         lock = self.resolve(self.runtime.get('lock'))
@@ -245,15 +343,15 @@ class SbatchForm(Configurable):
             self.form['runtime'].validators[-1].message = f'Runtime can only be {def_}'
         else:
             min_ = self.resolve(self.runtime.get('min'))
-            max_ = self.resolve(self.runtime.get('max'))
+            max_ = self.limit_max('runtime', self.selected_account())
             step = self.resolve(self.runtime.get('step'))
             self.form['runtime'].widget.min = min_
             self.form['runtime'].widget.max = max_
             self.form['runtime'].widget.step = step
-            if min_ is not None:
-                self.form['runtime'].validators[-1].min = min_
-            if max_ is not None:
-                self.form['runtime'].validators[-1].max = max_
+            # always reset the bounds, a previous call may have clamped them
+            # to the limits of another account
+            self.form['runtime'].validators[-1].min = min_
+            self.form['runtime'].validators[-1].max = max_
             self.form['runtime'].validators[-1].message = f'Runtime outside of allowed range [{min_}, {max_}]'
 
     def config_nprocs(self):
@@ -267,7 +365,7 @@ class SbatchForm(Configurable):
             self.form['nprocs'].validators[-1].max = def_
         else:
             min_ = self.resolve(self.nprocs.get('min'))
-            max_ = self.resolve(self.nprocs.get('max'))
+            max_ = self.limit_max('nprocs', self.selected_account())
             step = self.resolve(self.nprocs.get('step'))
             self.form['nprocs'].widget.min = min_
             self.form['nprocs'].widget.max = max_
@@ -286,7 +384,7 @@ class SbatchForm(Configurable):
             self.form['memory'].validators[-1].max = def_
         else:
             min_ = self.resolve(self.memory.get('min'))
-            max_ = self.resolve(self.memory.get('max'))
+            max_ = self.limit_max('memory', self.selected_account())
             step = self.resolve(self.memory.get('step'))
             self.form['memory'].widget.min = min_
             self.form['memory'].widget.max = max_
@@ -363,7 +461,12 @@ class SbatchForm(Configurable):
         self.form['gpus'].choices = list(gpu_choice_map.items())
         if lock:
             self.form['gpus'].render_kw = {'disabled': 'disabled'}
-        self.form['gpus'].validators[-1].values = [key for key, value in self.form['gpus'].choices]
+        # choices above the account limit stay listed, the form script disables
+        # them when the account changes
+        limit = self.slurm_api.get_account_limits(self.username).get(self.selected_account(), {}).get('gpus')
+        self.form['gpus'].validators[-1].values = [
+            key for key, value in self.form['gpus'].choices if limit is None or gpu_count(key) <= limit
+        ]
 
     def config_profile(self):
         choices = self.resolve(self.profile.get('choices'))
@@ -415,6 +518,21 @@ class SbatchForm(Configurable):
         if lock:
             self.form['feature'].render_kw = {'disabled': 'disabled'}
 
+    def config_estimates(self, estimates):
+        # absolute times keep the labels, and the options ETag, stable between estimates
+        for key in ('partition', 'gpus'):
+            starts = estimates.get(key, {})
+            choices = []
+            for value, label in self.form[key].choices:
+                if value in starts:
+                    start = starts[value]
+                    if start is None:
+                        label = f'{label} (start time unknown)'
+                    else:
+                        label = '{} (expected start {})'.format(label, start.strftime('%Y-%m-%d %H:%M'))
+                choices.append((value, label))
+            self.form[key].choices = choices
+
     def validate_features(self, form, field):
         selected_features = set(field.data)
         # No feature constraints have been selected
@@ -440,6 +558,16 @@ class SbatchForm(Configurable):
         )
         raise Exception(message)
 
+    def config_reservation_ends(self):
+        """Label the reservations with their end time instead of the time
+        left, which would change the options ETag on every request."""
+        choices = self.resolve(self.reservation.get('choices')) or []
+        ends = {rsv['ReservationName']: rsv['EndTime'] for rsv in choices}
+        self.form['reservation'].choices = [
+            (name, '{} - ends: {}'.format(name, ends[name].strftime('%Y-%m-%d %H:%M:%S')) if name in ends else label)
+            for name, label in self.form['reservation'].choices
+        ]
+
     def config_reservations(self):
         choices = self.resolve(self.reservation.get('choices'))
         lock = self.resolve(self.reservation.get('lock'))
@@ -0,0 +1,38 @@
+import json
+
+from jupyterhub.handlers import BaseHandler
+from tornado import web
+from tornado.ioloop import IOLoop
+
+from .spawner import OPTIONS_PATH, SlurmFormSpawner
+
+class SlurmFormOptionsHandler(BaseHandler):
+    """Serve the choices of the spawner form of the current user in JSON.
+
+    Tornado derives the ETag header from the response body, which only changes
+    when the Slurm snapshots do, and answers 304 when the browser already has it.
+    """
+
+    def get_content_type(self):
+        return 'application/json'
+
+    @web.authenticated
+    async def get(self):
+        server_name = self.get_argument('server_name', '')
+        if server_name not in self.current_user.orm_spawners:
+            raise web.HTTPError(404, f"No server named {server_name!r}")
+        spawner = self.current_user.get_spawner(server_name, replace_failed=True)
+        if not isinstance(spawner, SlurmFormSpawner):
+            raise web.HTTPError(404)
+        # options_data can wait on Slurm, keep the hub responsive meanwhile. The
+        # ORM objects belong to the event loop, read them before leaving it.
+        user_options = dict(spawner.orm_spawner.user_options or {})
+        data = await IOLoop.current().run_in_executor(None, spawner.options_data,
+                                                      self.current_user.name, user_options)
+        # the browser has to revalidate with the ETag before reusing its copy
+        self.set_header('Cache-Control', 'private, no-cache')
+        self.write(json.dumps(data))
+
+default_handlers = [
+    (OPTIONS_PATH, SlurmFormOptionsHandler),
+]
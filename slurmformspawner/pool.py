@@ -0,0 +1,195 @@
+import asyncio
+import getpass
+import math
+import shlex
+
+from datetime import datetime
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from traitlets.config import SingletonConfigurable
+from traitlets import Dict, Integer, Unicode
+
+from .slurm import SlurmAPI
+
+JOB_NAME_PREFIX = 'slurmformspawner-pool-'
+
+class WarmPool(SingletonConfigurable):
+    """Keep placeholder jobs running for popular profiles.
+
+    A placeholder job holds the resources of a profile on a node. When a user
+    requests exactly this profile, the user job is submitted pinned to that
+    node, then the placeholder is cancelled. The user job is already pending
+    when the node frees up, which makes an early start likely, not certain.
+    """
+
+    profiles = Dict(
+        {},
+        help="Number of placeholder jobs to keep running for each profile of SlurmFormSpawner.profile_args"
+    ).tag(config=True)
+
+    ttl = Integer(
+        3600,
+        help="Time after which a running placeholder job is replaced by a new one (seconds)"
+    ).tag(config=True)
+
+    refresh_interval = Integer(
+        30,
+        help="Time between two checks of the placeholder jobs (seconds)"
+    ).tag(config=True)
+
+    account = Unicode(
+        '',
+        help="Slurm account charged for the placeholder jobs"
+    ).tag(config=True)
+
+    user = Unicode(
+        getpass.getuser(),
+        help="User submitting the placeholder jobs"
+    ).tag(config=True)
+
+    submit_cmd = Unicode(
+        'sbatch --parsable',
+        help="Command submitting a placeholder job"
+    ).tag(config=True)
+
+    cancel_cmd = Unicode(
+        'scancel',
+        help="Command cancelling a placeholder job"
+    ).tag(config=True)
+
+    timeout = Integer(10, help="Timeout of the Slurm calls of the pool (seconds)").tag(config=True)
+
+    def __init__(self, config=None):
+        super().__init__(config=config)
+        self.slurm_api = SlurmAPI.instance(config)
+        self.build_requests = None
+        self.requests = {}
+        self.jobs = []
+        # placeholder jobs handed out, squeue can list them until they end
+        self.acquired = set()
+        # number of jobs handed out per profile whose user job is not submitted yet
+        self.handoffs = {}
+        self.callback = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def started(self):
+        return self.callback is not None
+
+    def start(self, build_requests):
+        """Start maintaining the pool. build_requests returns a dict mapping
+        each pooled profile to the sbatch options of its placeholder job. It
+        can query Slurm, so it is called off the event loop."""
+        if self.started:
+            return
+        self.build_requests = build_requests
+        self.callback = PeriodicCallback(self.refresh, self.refresh_interval * 1000)
+        self.callback.start()
+        asyncio.ensure_future(self.refresh())
+
+    async def run(self, cmd):
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(f"{' '.join(cmd)} exited with status {process.returncode}: {err.decode().strip()}")
+        return out.decode()
+
+    async def list_jobs(self):
+        output = await self.run(['squeue', '--noheader', '--user', self.user, '--format', '%i|%j|%T|%N|%S'])
+        jobs = []
+        for line in output.splitlines():
+            job_id, name, state, node, start = line.split('|')
+            if not name.startswith(JOB_NAME_PREFIX):
+                continue
+            try:
+                start = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S')
+            except ValueError:
+                start = None
+            jobs.append({'id': job_id, 'profile': name[len(JOB_NAME_PREFIX):], 'state': state,
+                         'node': node, 'start': start})
+        return jobs
+
+    async def submit(self, profile):
+        # let Slurm end the placeholder if the hub stops maintaining the pool
+        time_limit = math.ceil((self.ttl + 2 * self.refresh_interval) / 60)
+        cmd = shlex.split(self.submit_cmd) + [
+            f'--job-name={JOB_NAME_PREFIX}{profile}',
+            f'--time={time_limit}',
+            *self.requests[profile],
+            '--wrap=sleep infinity',
+        ]
+        if self.account:
+            cmd.insert(-1, f'--account={self.account}')
+        job_id = await self.run(cmd)
+        self.log.info("Submitted placeholder job %s for profile %s", job_id.strip(), profile)
+
+    async def cancel(self, job):
+        await self.run(shlex.split(self.cancel_cmd) + [job['id']])
+
+    async def refresh(self):
+        if self.slurm_api.breaker_open():
+            return
+        async with self.lock:
+            try:
+                if not self.requests:
+                    self.requests = await IOLoop.current().run_in_executor(None, self.build_requests)
+                jobs = await self.list_jobs()
+                self.acquired.intersection_update(job['id'] for job in jobs)
+                jobs = [job for job in jobs if job['id'] not in self.acquired]
+                now = datetime.now()
+                for job in jobs:
+                    if job['profile'] not in self.requests or (
+                        job['start'] is not None and job['state'] == 'RUNNING' and
+                        (now - job['start']).total_seconds() > self.ttl
+                    ):
+                        await self.cancel(job)
+                        job['state'] = 'CANCELLED'
+                self.jobs = [job for job in jobs if job['state'] in ('PENDING', 'RUNNING')]
+                for profile in self.requests:
+                    count = sum(job['profile'] == profile for job in self.jobs) + self.handoffs.get(profile, 0)
+                    for _ in range(self.profiles.get(profile, 0) - count):
+                        await self.submit(profile)
+            except (asyncio.TimeoutError, OSError, RuntimeError, ValueError) as error:
+                self.log.warning("Could not refresh the warm pool: %s", error)
+
+    async def acquire(self, profile):
+        """Reserve a running placeholder job of profile and return it, or None
+        if the pool has no running job for profile. The placeholder keeps its
+        node until hand_off cancels it, so submit the user job pinned to
+        job['node'] first, then call hand_off, or restore if the submission
+        failed."""
+        async with self.lock:
+            for job in self.jobs:
+                if job['profile'] == profile and job['state'] == 'RUNNING':
+                    self.jobs.remove(job)
+                    self.acquired.add(job['id'])
+                    self.handoffs[profile] = self.handoffs.get(profile, 0) + 1
+                    return job
+        return None
+
+    async def hand_off(self, job):
+        """Cancel the placeholder job reserved by acquire, so the user job
+        pending on its node can start, and submit its replacement. Return
+        False if the placeholder could not be cancelled, in which case it is
+        returned to the pool."""
+        try:
+            await self.cancel(job)
+        except (asyncio.TimeoutError, OSError, RuntimeError) as error:
+            self.log.warning("Could not release placeholder job %s: %s", job['id'], error)
+            await self.restore(job)
+            return False
+        self.handoffs[job['profile']] -= 1
+        asyncio.ensure_future(self.refresh())
+        return True
+
+    async def restore(self, job):
+        """Return a placeholder job reserved by acquire to the pool"""
+        async with self.lock:
+            self.acquired.discard(job['id'])
+            self.handoffs[job['profile']] -= 1
+            self.jobs.append(job)
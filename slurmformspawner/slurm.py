@@ -1,43 +1,221 @@
 import json
+import re
 
 from operator import attrgetter
 from traitlets.config import SingletonConfigurable
 from traitlets import Integer
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, run as run_process, PIPE, STDOUT, SubprocessError, TimeoutExpired
+from threading import Lock
+from time import monotonic
 
-from cachetools import TTLCache, cachedmethod
+from cachetools import LRUCache, TTLCache, cachedmethod
+
+class CircuitOpenError(SubprocessError):
+    """Raised instead of calling Slurm while the circuit breaker is open"""
+
+class NoEstimateError(Exception):
+    """Raised when sbatch --test-only does not report a start time"""
+
+MEMORY_UNITS = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2, 'P': 1024 ** 3}
+
+def parse_walltime(string):
+    """Convert a Slurm time limit ([days-]hours:minutes:seconds, minutes:seconds
+    or minutes) to hours."""
+    days = 0
+    if '-' in string:
+        days, string = string.split('-', 1)
+    parts = [int(part) for part in string.split(':')]
+    if len(parts) == 3:
+        hours, minutes, seconds = parts
+    elif len(parts) == 2:
+        hours, minutes, seconds = 0, parts[0], parts[1]
+    else:
+        hours, minutes, seconds = 0, parts[0], 0
+    return int(days) * 24 + hours + minutes / 60 + seconds / 3600
+
+def parse_tres(string):
+    """Convert a Slurm TRES string (cpu=16,mem=64G,gres/gpu=2) to the
+    form widgets limits: nprocs, memory (MB) and gpus. Values that cannot be
+    parsed are ignored."""
+    limits = {}
+    for tres in string.split(','):
+        name, _, value = tres.partition('=')
+        if name == 'mem':
+            match = re.fullmatch(r'(\d+)([KMGTP]?)', value)
+            if match:
+                limits['memory'] = int(int(match.group(1)) * MEMORY_UNITS[match.group(2) or 'M'])
+        elif name in ('cpu', 'gres/gpu') and value.isdigit():
+            limits['nprocs' if name == 'cpu' else 'gpus'] = int(value)
+    return limits
+
+def parse_limits(maxwall, maxtres):
+    """Return the limits set by MaxWall and MaxTRES. A limit is left unset
+    when its value cannot be parsed, e.g. UNLIMITED."""
+    limits = {}
+    if maxwall:
+        try:
+            limits['runtime'] = parse_walltime(maxwall)
+        except ValueError:
+            pass
+    if maxtres:
+        limits.update(parse_tres(maxtres))
+    return limits
 
 class SlurmAPI(SingletonConfigurable):
     info_cache_ttl = Integer(300).tag(config=True)
     acct_cache_ttl = Integer(300).tag(config=True)
     acct_cache_size = Integer(100).tag(config=True)
     res_cache_ttl = Integer(300).tag(config=True)
+    scontrol_timeout = Integer(10, help="Timeout of scontrol calls (seconds)").tag(config=True)
+    sacctmgr_timeout = Integer(10, help="Timeout of sacctmgr calls (seconds)").tag(config=True)
+    sbatch_timeout = Integer(10, help="Timeout of sbatch --test-only calls (seconds)").tag(config=True)
+    estimate_cache_ttl = Integer(60).tag(config=True)
+    estimate_cache_size = Integer(1000).tag(config=True)
+    breaker_threshold = Integer(
+        3,
+        help="Number of consecutive failed Slurm calls before the circuit breaker opens"
+    ).tag(config=True)
+    breaker_cooldown = Integer(
+        60,
+        help="Time during which Slurm is not called once the circuit breaker is open (seconds)"
+    ).tag(config=True)
+    prefetch_workers = Integer(
+        5,
+        help="Number of threads used to query Slurm concurrently when prefetching, at least one per prefetched query"
+    ).tag(config=True)
+    estimate_workers = Integer(
+        4,
+        help="Number of threads running sbatch --test-only concurrently to estimate start times"
+    ).tag(config=True)
 
     def __init__(self, config=None):
         super().__init__(config=config)
         self.info_cache = TTLCache(maxsize=1, ttl=self.info_cache_ttl)
         self.acct_cache = TTLCache(maxsize=self.acct_cache_size, ttl=self.acct_cache_ttl)
         self.res_cache = TTLCache(maxsize=1, ttl=self.res_cache_ttl)
+        self.assoc_cache = TTLCache(maxsize=self.acct_cache_size, ttl=self.acct_cache_ttl)
+        self.qos_cache = TTLCache(maxsize=1, ttl=self.acct_cache_ttl)
+        self.estimate_cache = TTLCache(maxsize=self.estimate_cache_size, ttl=self.estimate_cache_ttl)
+        # caches are shared by the prefetch threads
+        self.info_lock = Lock()
+        self.acct_lock = Lock()
+        self.res_lock = Lock()
+        self.assoc_lock = Lock()
+        self.qos_lock = Lock()
+        self.estimate_lock = Lock()
+        # one thread per query at least, so a cold prefetch takes as long as the slowest one
+        self.executor = ThreadPoolExecutor(max_workers=max(self.prefetch_workers, len(self.prefetch_queries(''))),
+                                           thread_name_prefix='slurmapi')
+        # estimates wait on sbatch, keep them from delaying the prefetch of the form
+        self.estimate_executor = ThreadPoolExecutor(max_workers=self.estimate_workers,
+                                                    thread_name_prefix='slurmapi-estimate')
+        self.breaker_lock = Lock()
+        self.snapshot_lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+        # last known good value of each query, when it was fetched and whether
+        # it is currently served in place of a failed query. Per user queries
+        # are bounded like the account cache.
+        self.snapshots = {}
+        self.user_snapshots = LRUCache(maxsize=self.acct_cache_size)
+
+    def breaker_open(self):
+        with self.breaker_lock:
+            if self.failures < self.breaker_threshold:
+                return False
+            return monotonic() - self.opened_at < self.breaker_cooldown
+
+    def record_failure(self, what, error):
+        with self.breaker_lock:
+            self.failures += 1
+            if self.failures >= self.breaker_threshold:
+                if self.opened_at is None or monotonic() - self.opened_at >= self.breaker_cooldown:
+                    self.log.warning("Slurm circuit breaker opened for %ss after %s failures, last: %s (%s)",
+                                     self.breaker_cooldown, self.failures, what, error)
+                self.opened_at = monotonic()
+
+    def record_success(self):
+        with self.breaker_lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def run(self, cmd, timeout):
+        if self.breaker_open():
+            raise CircuitOpenError(f"circuit breaker is open, not running {cmd[0]}")
+        try:
+            output = check_output(cmd, encoding='utf-8', timeout=timeout)
+        except (SubprocessError, OSError) as error:
+            self.record_failure(' '.join(cmd), error)
+            raise
+        # the caller records the success once the output is parsed
+        return output
+
+    def snapshot_store(self, key):
+        # per user keys are tuples ending with the username
+        return self.user_snapshots if isinstance(key, tuple) else self.snapshots
+
+    def last_known_good(self, key, func, *args, default):
+        try:
+            value = func(*args)
+        except (SubprocessError, OSError, ValueError) as error:
+            if isinstance(error, ValueError):
+                # unexpected output, e.g. truncated JSON, is a failure too
+                self.record_failure(key, error)
+            with self.snapshot_lock:
+                snapshot = self.snapshot_store(key).get(key)
+                if snapshot is None:
+                    return default
+                snapshot['stale'] = True
+                return snapshot['value']
+        with self.snapshot_lock:
+            self.snapshot_store(key)[key] = {'date': datetime.now(), 'value': value, 'stale': False}
+        return value
+
+    def stale_since(self, username):
+        """Return the fetch time of the oldest snapshot currently served to username
+        in place of a failed Slurm query, or None if every query answered."""
+        with self.snapshot_lock:
+            snapshots = list(self.snapshots.values()) + [
+                snapshot for key, snapshot in self.user_snapshots.items() if key[-1] == username
+            ]
+        return min((snapshot['date'] for snapshot in snapshots if snapshot['stale']), default=None)
+
+    def prefetch_queries(self, username):
+        return [
+            (self.get_node_info,),
+            (self.get_accounts, username),
+            (self.get_reservations,),
+            (self.get_associations, username),
+            (self.get_qos_limits,),
+        ]
+
+    def prefetch(self, username):
+        """Run the queries needed to build the form of username concurrently
+        and wait for all of them, so that the form is built from warm caches."""
+        futures = [self.executor.submit(*query) for query in self.prefetch_queries(username)]
+        wait(futures)
 
-    @cachedmethod(attrgetter('info_cache'))
     def get_node_info(self):
         output = {'cpu': [], 'mem': [], 'gres': [], 'partitions': [], 'features': set()}
-        try:
-            controls = check_output(['scontrol', '--json', 'show', 'node'], encoding='utf-8')
-        except CalledProcessError:
-            return output
-        else:
-            nodes = json.loads(controls).get('nodes', [])
-            for node in nodes:
-                output['cpu'].append(node['cpus'])
-                output['mem'].append(node['real_memory'] - node.get('specialized_memory', 0))
-                if node['gres']:
-                    output['gres'].append(node['gres'])
-                output['partitions'].extend(node.get('partitions', []))
-                if node.get('active_features', []):
-                    output['features'].add(frozenset(node['active_features']))
+        return self.last_known_good('node_info', self.query_node_info, default=output)
+
+    @cachedmethod(attrgetter('info_cache'), lock=attrgetter('info_lock'))
+    def query_node_info(self):
+        output = {'cpu': [], 'mem': [], 'gres': [], 'partitions': [], 'features': set()}
+        controls = self.run(['scontrol', '--json', 'show', 'node'], self.scontrol_timeout)
+        nodes = json.loads(controls).get('nodes', [])
+        for node in nodes:
+            output['cpu'].append(node['cpus'])
+            output['mem'].append(node['real_memory'] - node.get('specialized_memory', 0))
+            if node['gres']:
+                output['gres'].append(node['gres'])
+            output['partitions'].extend(node.get('partitions', []))
+            if node.get('active_features', []):
+                output['features'].add(frozenset(node['active_features']))
+        self.record_success()
         return output
 
     def is_online(self):
@@ -64,23 +242,80 @@ class SlurmAPI(SingletonConfigurable):
         features = {feature for feature_set in feature_sets for feature in feature_set}
         return sorted(features)
 
-    @cachedmethod(attrgetter('acct_cache'))
     def get_accounts(self, username):
-        try:
-            string = check_output(['sacctmgr', 'show', 'user', username, 'withassoc',
-                                    'format=account', '-P', '--noheader'], encoding='utf-8')
-        except CalledProcessError:
-            return []
+        return self.last_known_good(('accounts', username), self.query_accounts, username, default=[])
+
+    @cachedmethod(attrgetter('acct_cache'), lock=attrgetter('acct_lock'))
+    def query_accounts(self, username):
+        string = self.run(['sacctmgr', 'show', 'user', username, 'withassoc',
+                           'format=account', '-P', '--noheader'], self.sacctmgr_timeout)
+        self.record_success()
         return string.splitlines()
 
-    @cachedmethod(attrgetter('res_cache'))
+    def get_associations(self, username):
+        return self.last_known_good(('associations', username), self.query_associations, username, default={})
+
+    @cachedmethod(attrgetter('assoc_cache'), lock=attrgetter('assoc_lock'))
+    def query_associations(self, username):
+        string = self.run(['sacctmgr', 'show', 'assoc', f'user={username}',
+                           'format=account,maxwall,maxtres,defaultqos,qos',
+                           '-P', '--noheader'], self.sacctmgr_timeout)
+        associations = {}
+        for line in string.splitlines():
+            fields = line.split('|')
+            if len(fields) != 5:
+                self.log.warning("Ignoring unexpected sacctmgr association line: %s", line)
+                continue
+            account, maxwall, maxtres, defaultqos, qos = fields
+            qos = qos.split(',') if qos else []
+            if not defaultqos and len(qos) == 1:
+                defaultqos = qos[0]
+            limits = parse_limits(maxwall, maxtres)
+            if account in associations:
+                # An account can have one association per partition. Since the
+                # partition is not known when clamping the form, keep the least
+                # restrictive value so that no valid request gets rejected.
+                previous = associations[account]['limits']
+                limits = {key: max(limits[key], previous[key]) for key in limits.keys() & previous.keys()}
+            associations[account] = {'limits': limits, 'qos': defaultqos}
+        self.record_success()
+        return associations
+
+    def get_qos_limits(self):
+        return self.last_known_good('qos', self.query_qos_limits, default={})
+
+    @cachedmethod(attrgetter('qos_cache'), lock=attrgetter('qos_lock'))
+    def query_qos_limits(self):
+        string = self.run(['sacctmgr', 'show', 'qos', 'format=name,maxwall,maxtres',
+                           '-P', '--noheader'], self.sacctmgr_timeout)
+        qos_limits = {}
+        for line in string.splitlines():
+            fields = line.split('|')
+            if len(fields) != 3:
+                self.log.warning("Ignoring unexpected sacctmgr qos line: %s", line)
+                continue
+            name, maxwall, maxtres = fields
+            qos_limits[name] = parse_limits(maxwall, maxtres)
+        self.record_success()
+        return qos_limits
+
+    def get_account_limits(self, username):
+        """Return for each account of username its limits on runtime (hours),
+        nprocs, memory (MB) and gpus. Like in Slurm, a limit set by the default
+        QOS overrides the association limit, even when it is higher."""
+        qos_limits = self.get_qos_limits()
+        limits = {}
+        for account, assoc in self.get_associations(username).items():
+            limits[account] = {**assoc['limits'], **qos_limits.get(assoc['qos'], {})}
+        return limits
+
     def get_reservations(self):
-        try:
-            reservations = check_output(['scontrol', 'show', 'res', '--json'], encoding='utf-8')
-        except CalledProcessError:
-            reservations = []
-        else:
-            reservations = json.loads(reservations).get('reservations', [])
+        return self.last_known_good('reservations', self.query_reservations, default=[])
+
+    @cachedmethod(attrgetter('res_cache'), lock=attrgetter('res_lock'))
+    def query_reservations(self):
+        reservations = self.run(['scontrol', 'show', 'res', '--json'], self.scontrol_timeout)
+        reservations = json.loads(reservations).get('reservations', [])
 
         filtered_reservations = []
         for res in reservations:
@@ -94,6 +329,7 @@ class SlurmAPI(SingletonConfigurable):
             current_res['StartTime'] = datetime.fromtimestamp(res['start_time']['number'])
             current_res['EndTime'] = datetime.fromtimestamp(res['end_time']['number'])
             filtered_reservations.append(current_res)
+        self.record_success()
         return filtered_reservations
 
     def get_active_reservations(self, username, accounts):
@@ -113,3 +349,59 @@ class SlurmAPI(SingletonConfigurable):
                 )
             )
         ]
+
+    def get_summary(self, username):
+        """Return the cluster resources and the accounts and active reservations
+        of username in a JSON serializable dictionary."""
+        accounts = self.get_accounts(username)
+        return {
+            'cpus': self.get_cpus(),
+            'mems': self.get_mems(),
+            'gres': self.get_gres(),
+            'partitions': self.get_partitions(),
+            'features': self.get_features(),
+            'accounts': accounts,
+            'reservations': [
+                {'name': res['ReservationName'], 'end_time': res['EndTime'].strftime('%Y-%m-%dT%H:%M:%S')}
+                for res in self.get_active_reservations(username, accounts)
+            ],
+        }
+
+    def estimate_start_times(self, cmd, candidates):
+        """Run sbatch --test-only concurrently for each candidate. This waits
+        on Slurm, do not call it from the event loop.
+
+        cmd is the sbatch --test-only command as a tuple and candidates a dict
+        of tuples of sbatch options. Return a dict with the same keys giving the
+        expected start time of each candidate, or None if it cannot be estimated.
+        """
+        futures = {
+            key: self.estimate_executor.submit(self.estimate_start_time, cmd, args)
+            for key, args in candidates.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def estimate_start_time(self, cmd, args):
+        if self.breaker_open():
+            return None
+        try:
+            return self.query_start_time(cmd, args)
+        except (TimeoutExpired, OSError) as error:
+            self.record_failure(' '.join(cmd), error)
+        except NoEstimateError:
+            pass
+        return None
+
+    @cachedmethod(attrgetter('estimate_cache'), lock=attrgetter('estimate_lock'))
+    def query_start_time(self, cmd, args):
+        # Only start times are cached. The errors raised otherwise are not, so
+        # an outage does not hide estimates once Slurm answers again.
+        process = run_process(cmd + args, stdout=PIPE, stderr=STDOUT, encoding='utf-8', timeout=self.sbatch_timeout)
+        match = re.search(r'to start at (\S+)', process.stdout)
+        if process.returncode == 0 and match is not None:
+            return datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+        if re.search(r'unable to contact slurm controller', process.stdout, re.IGNORECASE):
+            self.record_failure(' '.join(cmd), process.stdout.strip())
+        # Otherwise the request cannot be satisfied with these options, which
+        # does not tell anything about the health of Slurm.
+        raise NoEstimateError(process.stdout.strip())
@@ -1,13 +1,23 @@
 import os
+import shlex
 import sys
 
+from functools import partial
+
 from jupyterhub import __version__ as hub_version
+from jupyterhub.app import JupyterHub
+from jupyterhub.utils import url_path_join
+from tornado.httputil import url_concat
+from tornado.ioloop import IOLoop
 from batchspawner import SlurmSpawner
 from traitlets import CBool, Unicode, Dict
 
 from . form import SbatchForm
+from . pool import WarmPool
 from . slurm import SlurmAPI
 
+OPTIONS_PATH = r'/slurmformspawner/options'
+
 class SlurmFormSpawner(SlurmSpawner):
     disable_form = CBool(
         False,
@@ -35,6 +45,21 @@ class SlurmFormSpawner(SlurmSpawner):
             help="Dictionary of dictionaries describing profiles"
             ).tag(config=True)
 
+    async_form = CBool(
+        False,
+        help="Render the spawner form without querying Slurm and let the form fetch its choices from the options endpoint"
+    ).tag(config=True)
+
+    estimate_start = CBool(
+        False,
+        help="Show the expected start time of each partition and GPU configuration in the form, using sbatch --test-only"
+    ).tag(config=True)
+
+    auto_select_partition = CBool(
+        False,
+        help="Submit to the partition with the earliest expected start time when the user does not select one"
+    ).tag(config=True)
+
     slurm_bin_path = Unicode(
         '/opt/slurm/bin',
         help="Absolute path to Slurm executables"
@@ -54,17 +79,12 @@ class SlurmFormSpawner(SlurmSpawner):
     env_keep = []
     batch_submit_cmd = "sudo --preserve-env={keepvars} -u {username} {slurm_bin_path}/sbatch --parsable"
     batch_cancel_cmd = "sudo -u {username} {slurm_bin_path}/scancel {job_id}"
+    batch_test_cmd = "sudo -u {username} {slurm_bin_path}/sbatch --test-only"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.slurm_api = SlurmAPI.instance(self.config)
-        self.form = SbatchForm(username=self.user.name,
-                               slurm_api=self.slurm_api,
-                               ui_args=self.ui_args,
-                               profile_args=self.profile_args,
-                               user_options=self.orm_spawner.user_options or {},
-                               config=self.config,
-                               hub_version=hub_version)
+        self.form = self.new_form(self.user.name, self.orm_spawner.user_options or {})
 
         self.batch_submit_cmd = self.batch_submit_cmd.format(
             username='{username}',
@@ -76,6 +96,29 @@ class SlurmFormSpawner(SlurmSpawner):
             job_id='{job_id}',
             slurm_bin_path=self.slurm_bin_path
         )
+        self.batch_test_cmd = self.batch_test_cmd.format(
+            username=self.user.name,
+            slurm_bin_path=self.slurm_bin_path
+        )
+
+        if self.async_form and not self.options_endpoint_registered():
+            self.log.warning("SlurmFormSpawner.async_form requires the options endpoint in JupyterHub.extra_handlers, "
+                             "rendering the form synchronously.")
+            self.async_form = False
+        if self.estimate_start and not self.async_form:
+            self.log.warning("SlurmFormSpawner.estimate_start requires async_form, no start time will be shown.")
+        if self.auto_select_partition and self.form.partition.get('lock'):
+            self.log.warning("SlurmFormSpawner.auto_select_partition requires SbatchForm.partition to be unlocked, "
+                             "the partition will not be selected.")
+
+        self.warm_node = ''
+        self.warm_job = None
+        self.warm_pool = WarmPool.instance(self.config)
+        if self.warm_pool.profiles and not self.warm_pool.started:
+            undefined = set(self.warm_pool.profiles) - {'default'} - set(self.profile_args)
+            if undefined:
+                raise Exception(f'WarmPool.profiles refers to profiles missing from profile_args: {", ".join(sorted(undefined))}.')
+            self.warm_pool.start(partial(self.placeholder_requests, self.user.name))
 
         with open(self.error_template_path, 'r') as file_:
             self.error_form = file_.read()
@@ -83,12 +126,37 @@ class SlurmFormSpawner(SlurmSpawner):
         with open(self.submit_template_path, 'r') as script_template:
             self.batch_script = script_template.read()
 
+    def options_endpoint_registered(self):
+        """Return True if the options endpoint is registered. JupyterHub
+        deprecated extra_handlers in 3.1, the form is rendered synchronously
+        once it is gone."""
+        if not JupyterHub.class_traits().get('extra_handlers'):
+            return False
+        handlers = self.config.JupyterHub.get('extra_handlers', [])
+        return any(handler[0] == OPTIONS_PATH for handler in handlers)
+
+    def new_form(self, username, user_options):
+        # username and user_options are plain values, the forms built off the
+        # event loop must not touch the ORM objects of the hub
+        return SbatchForm(username=username,
+                          slurm_api=self.slurm_api,
+                          ui_args=self.ui_args,
+                          profile_args=self.profile_args,
+                          user_options=user_options,
+                          config=self.config,
+                          hub_version=hub_version)
+
     @property
     def user_options(self):
-        options = self.form.data.copy()
+        options = self.form_options(self.form)
+        options['nodelist'] = self.warm_node
+        return options
+
+    def form_options(self, form):
+        options = form.data.copy()
         options['runtime'] = int(options['runtime'] * 60)
         options['constraint'] = "&".join(options.pop('feature', []))
-        ui = self.form.data.get('ui')
+        ui = form.data.get('ui')
         options['modules'] = self.ui_args[ui].get('modules', [])
         return options
 
@@ -96,6 +164,72 @@ class SlurmFormSpawner(SlurmSpawner):
     def user_options(self, value):
         pass
 
+    async def start(self):
+        if self.auto_select_partition and self.form.data['partition'] == '':
+            await self.select_partition()
+        self.warm_node = ''
+        profile = self.form.data.get('profile')
+        if profile in self.warm_pool.profiles and self.matches_profile(profile):
+            self.warm_job = await self.warm_pool.acquire(profile)
+            if self.warm_job is not None:
+                self.warm_node = self.warm_job['node']
+        return await super().start()
+
+    async def submit_batch_script(self):
+        job, self.warm_job = self.warm_job, None
+        if job is None:
+            return await super().submit_batch_script()
+        # Submit the job pinned to the node of the placeholder before cancelling
+        # it, so the job is already pending when the node frees up.
+        try:
+            job_id = await super().submit_batch_script()
+        except Exception:
+            await self.warm_pool.restore(job)
+            raise
+        if not job_id:
+            await self.warm_pool.restore(job)
+            return job_id
+        if not await self.warm_pool.hand_off(job):
+            # the pinned job would wait for the placeholder to end, submit it anywhere
+            self.log.warning("Resubmitting job %s of %s without the node of the placeholder job", job_id, self.user.name)
+            await self.cancel_batch_job()
+            self.warm_node = ''
+            job_id = await super().submit_batch_script()
+        return job_id
+
+    def placeholder_requests(self, username):
+        """Return the sbatch options of the placeholder jobs of each pooled
+        profile. The pool calls it off the event loop, so it uses a form of its own."""
+        form = self.new_form(username, {})
+        form.load()
+        requests = {}
+        for profile in self.warm_pool.profiles:
+            params = {**form.profile_args['default']['params'], **form.profile_args[profile]['params']}
+            requests[profile] = self.placeholder_args(params)
+        return requests
+
+    def matches_profile(self, profile):
+        """Return True if the job requested can run in a placeholder job of profile"""
+        # placeholder jobs are submitted outside of any reservation
+        if self.form.data.get('reservation'):
+            return False
+        return self.placeholder_args(self.form.data) == self.warm_pool.requests.get(profile)
+
+    def placeholder_args(self, params):
+        options = {
+            'runtime': 0,
+            'memory': params['memory'],
+            'nprocs': params['nprocs'],
+            'gpus': params['gpus'],
+            'account': '',
+            'oversubscribe': params['oversubscribe'],
+            'reservation': '',
+            'partition': params['partition'],
+            'constraint': "&".join(sorted(params.get('feature') or [])),
+        }
+        # the pool sets its own time limit
+        return tuple(arg for arg in self.sbatch_args(options) if not arg.startswith('--time='))
+
     def get_args(self):
         args = super().get_args()
         ui = self.form.data.get('ui')
@@ -111,15 +245,95 @@ class SlurmFormSpawner(SlurmSpawner):
 
     @property
     def options_form(self):
+        if self.async_form and not self.disable_form:
+            options_url = url_path_join(self.hub.base_url, OPTIONS_PATH)
+            return self.form.render_shell(url_concat(options_url, {'server_name': self.name}))
+        self.slurm_api.prefetch(self.user.name)
         if self.slurm_api.is_online():
             if self.disable_form:
                 return None
             if self.form is not None:
-                return self.form.render()
+                return self.form.render(stale_since=self.slurm_api.stale_since(self.user.name))
         return self.error_form
 
+    def options_data(self, username, user_options):
+        """Return the content of the options endpoint. The handler calls it off
+        the event loop, so it configures a form of its own and leaves self.form
+        to the spawner."""
+        self.slurm_api.prefetch(username)
+        if not self.slurm_api.is_online():
+            return {'online': False, 'error': self.error_form}
+        form = self.new_form(username, user_options)
+        estimates = self.estimate_start_times(form) if self.estimate_start else None
+        return {
+            'online': True,
+            'summary': self.slurm_api.get_summary(username),
+            **form.options(stale_since=self.slurm_api.stale_since(username), estimates=estimates),
+        }
+
     def options_from_form(self, options):
+        if self.async_form:
+            # the choices were configured on the form of the options endpoint
+            self.form.configure()
         self.form.process(options)
         if not self.form.validate():
             raise Exception(', '.join((f"{key}: {error_list[0]}" for key, error_list in self.form.errors.items())))
         return self.form.data
+
+    def sbatch_args(self, options):
+        """Translate user options to the sbatch options of the submit script"""
+        args = [
+            f"--time={options['runtime']}",
+            f"--mem={options['memory']}",
+            f"--cpus-per-task={options['nprocs']}",
+            f"--gres={options['gpus']}",
+        ]
+        if options['account']:
+            args.append(f"--account={options['account']}")
+        if options['oversubscribe']:
+            args.append("--oversubscribe")
+        if options['reservation']:
+            args.append(f"--reservation={options['reservation']}")
+        if options['partition'] != "":
+            args.append(f"--partition={options['partition']}")
+        if options['constraint'] != "":
+            args.append(f"--constraint={options['constraint']}")
+        return tuple(args)
+
+    def estimate_candidates(self, form, keys):
+        """Return the sbatch options of every unlocked choice of keys, the
+        other options keeping their current value in form."""
+        form.config_partition()
+        form.config_gpus()
+        options = self.form_options(form)
+        candidates = {}
+        for key in keys:
+            if form.resolve(getattr(form, key).get('lock')):
+                continue
+            for value in form.form[key].validators[-1].values:
+                candidates[(key, value)] = self.sbatch_args({**options, key: value}) + ("--wrap=true",)
+        return candidates
+
+    def estimate_start_times(self, form, keys=('partition', 'gpus')):
+        """Estimate the start time of the job for every unlocked partition and
+        gpu configuration choice. This waits on sbatch, do not call it from the
+        event loop."""
+        candidates = self.estimate_candidates(form, keys)
+        cmd = tuple(shlex.split(self.batch_test_cmd))
+        estimates = {key: {} for key in keys}
+        for (key, value), start in self.slurm_api.estimate_start_times(cmd, candidates).items():
+            estimates[key][value] = start
+        return estimates
+
+    async def select_partition(self):
+        candidates = self.estimate_candidates(self.form, keys=('partition',))
+        cmd = tuple(shlex.split(self.batch_test_cmd))
+        starts = await IOLoop.current().run_in_executor(None, self.slurm_api.estimate_start_times, cmd, candidates)
+        starts = {partition: start for (_, partition), start in starts.items() if start is not None}
+        if starts:
+            partition = min(starts, key=starts.get)
+            if partition == '':
+                # Slurm default partition is already the fastest
+                return
+            self.log.info("Selected partition %s for %s, expected start at %s", partition, self.user.name, starts[partition])
+            self.form.form['partition'].data = partition
@@ -0,0 +1,155 @@
+import asyncio
+import os
+
+from types import SimpleNamespace
+
+import pytest
+
+from batchspawner import SlurmSpawner
+from traitlets.config import Config
+
+from slurmformspawner import SlurmFormSpawner
+from slurmformspawner.pool import WarmPool, JOB_NAME_PREFIX
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'share', 'templates')
+
+
+class FakeSlurm:
+    """Answer the commands of the pool and record them"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.calls = []
+        self.fail_cancel = False
+
+    async def run(self, cmd):
+        self.calls.append(cmd[0])
+        if cmd[0] == 'squeue':
+            return ''.join(f'{id_}|{JOB_NAME_PREFIX}default|{state}|{node}|2020-01-01T00:00:00\n'
+                           for id_, state, node in self.jobs)
+        if cmd[0] == 'scancel':
+            if self.fail_cancel:
+                raise RuntimeError('scancel exited with status 1')
+            self.jobs = [job for job in self.jobs if job[0] != cmd[-1]]
+            return ''
+        self.jobs.append((str(100 + len(self.calls)), 'PENDING', ''))
+        return '100\n'
+
+
+@pytest.fixture
+def pool():
+    pool = WarmPool(config=Config({'WarmPool': {'profiles': {'default': 1}, 'ttl': 10 ** 9}}))
+    pool.slurm = FakeSlurm([('11', 'RUNNING', 'c1')])
+    pool.run = pool.slurm.run
+    pool.requests = {'default': ('--mem=1024',)}
+    return pool
+
+
+@pytest.fixture
+def spawner(pool):
+    config = Config()
+    config.SbatchForm.form_template_path = os.path.join(TEMPLATES, 'form.html')
+    config.SlurmFormSpawner.error_template_path = os.path.join(TEMPLATES, 'error.html')
+    config.SlurmFormSpawner.submit_template_path = os.path.join(TEMPLATES, 'submit.sh')
+    user = SimpleNamespace(name='alice', url='/user/alice/', server=None, escaped_name='alice')
+    orm_spawner = SimpleNamespace(user_options={}, name='', server=None, state=None)
+    spawner = SlurmFormSpawner(user=user, orm_spawner=orm_spawner, config=config)
+    spawner.warm_pool = pool
+    return spawner
+
+
+def test_acquired_job_stays_out_of_the_pool(pool):
+    async def scenario():
+        await pool.refresh()
+        job = await pool.acquire('default')
+        assert job['id'] == '11' and job['node'] == 'c1'
+        # the placeholder holds its node until the user job is submitted
+        assert 'scancel' not in pool.slurm.calls
+        await pool.refresh()
+        assert pool.jobs == []
+        # the job handed out still counts, no replacement yet
+        assert 'sbatch' not in pool.slurm.calls
+        return job
+
+    asyncio.run(scenario())
+
+
+def test_hand_off_cancels_then_replaces(pool):
+    async def scenario():
+        await pool.refresh()
+        job = await pool.acquire('default')
+        assert await pool.hand_off(job)
+        await asyncio.sleep(0.1)
+        assert pool.slurm.calls[-3:] == ['scancel', 'squeue', 'sbatch']
+        assert pool.handoffs['default'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_hand_off_failure_restores_the_job(pool):
+    async def scenario():
+        await pool.refresh()
+        job = await pool.acquire('default')
+        pool.slurm.fail_cancel = True
+        assert not await pool.hand_off(job)
+        assert pool.jobs == [job]
+        assert pool.acquired == set() and pool.handoffs['default'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_user_job_is_submitted_before_the_placeholder_is_cancelled(spawner, pool, monkeypatch):
+    events = []
+
+    async def submit_batch_script(self):
+        events.append(('sbatch', self.warm_node))
+        return '42'
+
+    async def cancel_batch_job(self):
+        events.append(('scancel', self.job_id))
+
+    monkeypatch.setattr(SlurmSpawner, 'submit_batch_script', submit_batch_script)
+    monkeypatch.setattr(SlurmSpawner, 'cancel_batch_job', cancel_batch_job)
+    original_run = pool.run
+
+    async def run(cmd):
+        if cmd[0] == 'scancel':
+            events.append(('scancel', cmd[-1]))
+        return await original_run(cmd)
+
+    pool.run = run
+
+    async def scenario():
+        await pool.refresh()
+        spawner.warm_job = await pool.acquire('default')
+        spawner.warm_node = spawner.warm_job['node']
+        assert await spawner.submit_batch_script() == '42'
+
+    asyncio.run(scenario())
+    assert events == [('sbatch', 'c1'), ('scancel', '11')]
+
+
+def test_user_job_is_resubmitted_unpinned_when_the_placeholder_stays(spawner, pool, monkeypatch):
+    events = []
+
+    async def submit_batch_script(self):
+        events.append(('sbatch', self.warm_node))
+        self.job_id = '42'
+        return self.job_id
+
+    async def cancel_batch_job(self):
+        events.append(('scancel', self.job_id))
+
+    monkeypatch.setattr(SlurmSpawner, 'submit_batch_script', submit_batch_script)
+    monkeypatch.setattr(SlurmSpawner, 'cancel_batch_job', cancel_batch_job)
+
+    async def scenario():
+        await pool.refresh()
+        spawner.warm_job = await pool.acquire('default')
+        spawner.warm_node = spawner.warm_job['node']
+        pool.slurm.fail_cancel = True
+        await spawner.submit_batch_script()
+
+    asyncio.run(scenario())
+    assert events == [('sbatch', 'c1'), ('scancel', '42'), ('sbatch', '')]
+    assert [job['id'] for job in pool.jobs] == ['11']